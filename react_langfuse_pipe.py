@@ -4,36 +4,86 @@ author: Michael Poluektov
 author_url: https://github.com/michaelpoluektov
 git_url: https://github.com/michaelpoluektov/OWUI-ReAct
 description: OpenAI ReAct
-required_open_webui_version: 0.4.3
-requirements: langchain-openai, langgraph, ollama, langchain_ollama
+required_open_webui_version: 0.5.0
+requirements: langchain-openai, langgraph, langchain_ollama, httpx, langfuse<3, diskcache
 version: 0.4.1
 licence: MIT
 """
 
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import operator
 import os
+import time
+import weakref
 from typing import AsyncGenerator, Awaitable, Callable, Optional, Protocol
 
-import ollama
+import httpx
+from diskcache import Cache
 from langchain_core.tools import StructuredTool
 from langchain_ollama import ChatOllama
 from langchain_openai import ChatOpenAI
 from langfuse.callback import CallbackHandler
 from langgraph.prebuilt import create_react_agent
-from openai import OpenAI
 from pydantic import BaseModel, Field
 
+logger = logging.getLogger(__name__)
+
 EmitterType = Optional[Callable[[dict], Awaitable[None]]]
 
+MODELS_CACHE_TTL = 60
+RESPONSE_CACHE_DIR = "/tmp/react_cache"
+CACHE_MAX_ENTRIES = 64
+
+
+def _bounded_insert(cache: dict, key, value, maxsize: int = CACHE_MAX_ENTRIES):
+    """Insert into an insertion-ordered dict, evicting the oldest entries."""
+    cache[key] = value
+    while len(cache) > maxsize:
+        del cache[next(iter(cache))]
+    return value
+
+
+# the current request's tool callables; the host injects per-request context
+# (user, emitter) into fresh wrappers, so they must never be shared
+_request_tools: contextvars.ContextVar[dict[str, Callable]] = contextvars.ContextVar(
+    "request_tools"
+)
+
+
+def _dispatch_tool(name: str):
+    async def call_tool(**kwargs):
+        return await _request_tools.get()[name](**kwargs)
+
+    return call_tool
+
+
+# keyed by the emitter function itself: closure cells are unhashable and
+# id()s get recycled, while weak keys vanish with the emitter
+_event_info_cache: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _extract_from_closure(event_emitter):
+    for request_info in map(operator.attrgetter("cell_contents"), event_emitter.__closure__):
+        if isinstance(request_info, dict):
+            return request_info.get("chat_id"), request_info.get("message_id")
+    return None, None
+
 
 def extract_event_info(event_emitter):
     if not event_emitter or not event_emitter.__closure__:
         return None, None
-    for cell in event_emitter.__closure__:
-        if isinstance(request_info := cell.cell_contents, dict):
-            chat_id = request_info.get("chat_id")
-            message_id = request_info.get("message_id")
-            return chat_id, message_id
-    return None, None
+    try:
+        info = _event_info_cache.get(event_emitter)
+        if info is None:
+            info = _extract_from_closure(event_emitter)
+            _event_info_cache[event_emitter] = info
+        return info
+    except TypeError:  # emitter can't be weak-referenced; probe it directly
+        return _extract_from_closure(event_emitter)
 
 
 class SendCitationType(Protocol):
@@ -44,11 +94,62 @@ class SendStatusType(Protocol):
     def __call__(self, status_message: str, done: bool) -> Awaitable[None]: ...
 
 
-def get_send_citation(__event_emitter__: EmitterType) -> SendCitationType:
-    async def send_citation(url: str, title: str, content: str):
-        if __event_emitter__ is None:
+class _StatusBatcher:
+    """Coalesces emitter payloads and flushes them concurrently, either every
+    50 ms or once 8 are pending, instead of one awaited emit per event."""
+
+    def __init__(
+        self,
+        event_emitter: EmitterType,
+        max_batch: int = 8,
+        interval: float = 0.05,
+    ):
+        self._emitter = event_emitter
+        self._max_batch = max_batch
+        self._interval = interval
+        self._pending: list[dict] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def put(self, payload: dict) -> None:
+        if self._emitter is None:
             return
-        await __event_emitter__(
+        self._pending.append(payload)
+        if len(self._pending) >= self._max_batch:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._interval, self._schedule_flush
+            )
+
+    def _schedule_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self._pending:
+            batch, self._pending = self._pending, []
+            # Open WebUI has no batch event type, so send the backlog as
+            # individual emits that at least run concurrently
+            await asyncio.gather(
+                *(self._emitter(p) for p in batch), return_exceptions=True
+            )
+
+    async def aclose(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush()
+
+
+def get_send_citation(batcher: _StatusBatcher) -> SendCitationType:
+    async def send_citation(url: str, title: str, content: str):
+        batcher.put(
             {
                 "type": "source",
                 "data": {
@@ -62,11 +163,9 @@ def get_send_citation(__event_emitter__: EmitterType) -> SendCitationType:
     return send_citation
 
 
-def get_send_status(__event_emitter__: EmitterType) -> SendStatusType:
+def get_send_status(batcher: _StatusBatcher) -> SendStatusType:
     async def send_status(status_message: str, done: bool):
-        if __event_emitter__ is None:
-            return
-        await __event_emitter__(
+        batcher.put(
             {
                 "type": "status",
                 "data": {"description": status_message, "done": done},
@@ -76,6 +175,99 @@ def get_send_status(__event_emitter__: EmitterType) -> SendStatusType:
     return send_status
 
 
+def prompt_cache_key(messages: list[dict]) -> str:
+    """Stable hash of the prompt prefix (system + first user turn), used as the
+    provider-side prompt-cache routing key so multi-turn chats reuse the prefix."""
+    prefix = [m for m in messages if m.get("role") == "system"]
+    for m in messages:
+        if m.get("role") == "user":
+            prefix.append(m)
+            break
+    dump = json.dumps(prefix, sort_keys=True, default=str)
+    return hashlib.sha256(dump.encode()).hexdigest()
+
+
+async def flush_callbacks(callbacks, timeout: float = 2) -> None:
+    for handler in callbacks:
+        try:
+            if isinstance(handler, _QueuedCallbackHandler):
+                await handler.aflush(timeout)
+            else:
+                await asyncio.wait_for(asyncio.to_thread(handler.flush), timeout)
+        except Exception:
+            pass
+
+
+class _QueuedCallbackHandler(CallbackHandler):
+    """Defers the Langfuse callbacks to a single background task, so trace
+    bookkeeping and uploads never run inline with token streaming."""
+
+    _DEFERRED = (
+        "on_llm_start",
+        "on_chat_model_start",
+        "on_llm_new_token",
+        "on_llm_end",
+        "on_llm_error",
+        "on_chain_start",
+        "on_chain_end",
+        "on_chain_error",
+        "on_tool_start",
+        "on_tool_end",
+        "on_tool_error",
+        "on_retriever_start",
+        "on_retriever_end",
+        "on_retriever_error",
+        "on_agent_action",
+        "on_agent_finish",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._drain_task: Optional[asyncio.Task] = None
+
+    def _enqueue(self, name: str, args: tuple, kwargs: dict) -> None:
+        # langchain dispatches sync callbacks from an executor thread, where
+        # asyncio.Queue and create_task are off limits; hop back to the loop
+        self._loop.call_soon_threadsafe(self._enqueue_on_loop, (name, args, kwargs))
+
+    def _enqueue_on_loop(self, item: tuple) -> None:
+        self._queue.put_nowait(item)
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while not self._queue.empty():
+            name, args, kwargs = self._queue.get_nowait()
+            method = getattr(CallbackHandler, name)
+            try:
+                if asyncio.iscoroutinefunction(method):
+                    await method(self, *args, **kwargs)
+                else:
+                    await asyncio.to_thread(method, self, *args, **kwargs)
+            except Exception:
+                pass
+
+    async def aflush(self, timeout: float = 2) -> None:
+        await asyncio.sleep(0)  # let enqueues scheduled via call_soon land first
+        if self._drain_task is not None and not self._drain_task.done():
+            await asyncio.wait_for(asyncio.shield(self._drain_task), timeout)
+        await asyncio.wait_for(asyncio.to_thread(self.flush), timeout)
+
+
+def _deferred_callback(name: str):
+    def method(self, *args, **kwargs):
+        self._enqueue(name, args, kwargs)
+
+    return method
+
+
+for _name in _QueuedCallbackHandler._DEFERRED:
+    if hasattr(CallbackHandler, _name):
+        setattr(_QueuedCallbackHandler, _name, _deferred_callback(_name))
+
+
 class Pipe:
     class Valves(BaseModel):
         OPENAI_BASE_URL: str = Field(
@@ -94,46 +286,87 @@ class Pipe:
             default="gpt-4o,gpt-4o-mini,gpt-4",
             description="Enabled models, comma-separated.",
         )
+        RESPONSE_CACHE_TTL: int = Field(
+            default=0,
+            description="Seconds to cache responses for repeated prompts, 0 disables.",
+        )
 
     def __init__(self):
         self.type = "manifold"
         self.valves = self.Valves(
             **{k: os.getenv(k, v.default) for k, v in self.Valves.model_fields.items()}
         )
-        print(f"{self.valves=}")
+        self._cfg_hash = None
+        self._models_cache = None
+        self._model_cache = {}
+        self._handler_cache = {}
+        self._tools_cache = {}
+        self._graph_cache = {}
+        self._response_cache = None
+        self._inflight: dict[str, asyncio.Future] = {}
+        logger.debug("valves=%r", self.valves)
 
-    def pipes(self) -> list[dict[str, str]]:
+    async def pipes(self) -> list[dict[str, str]]:
         try:
             self.setup()
         except Exception as e:
             return [{"id": "error", "name": f"Error: {e}"}]
+        if self._models_cache is not None:
+            expires_at, cached = self._models_cache
+            if time.monotonic() < expires_at:
+                return cached
         models = []
         self.model_sources = {}
-        if self.openai_kwargs:
-            try:
-                openai = OpenAI(**self.openai_kwargs)  # type: ignore
-                enabled_models = [
-                    m.strip() for m in self.valves.ENABLED_MODELS.split(",")
-                ]
-                oai_models = [
-                    m.id for m in openai.models.list().data if m.id in enabled_models
-                ]
-                models.extend(oai_models)
-                self.model_sources |= {m: "openai" for m in oai_models}
-            except Exception as e:
-                print(f"OpenAI error: {e}")
-        if self.ollama_kwargs:
-            try:
-                client = ollama.Client(host=self.valves.OLLAMA_URL)
-                ollama_models = [(m.get("name") or m.get("model")) for m in client.list()["models"]]
-                models.extend(ollama_models)
-                self.model_sources |= {m: "ollama" for m in ollama_models}
-            except Exception as e:
-                print(f"Ollama error: {e}")
-        return [{"id": m, "name": f"{self.valves.MODEL_PREFIX}/{m}"} for m in models]
+        async with httpx.AsyncClient(timeout=5) as client:
+            oai_models, ollama_models = await asyncio.gather(
+                self._list_openai_models(client), self._list_ollama_models(client)
+            )
+        models.extend(oai_models)
+        self.model_sources |= {m: "openai" for m in oai_models}
+        models.extend(ollama_models)
+        self.model_sources |= {m: "ollama" for m in ollama_models}
+        result = [{"id": m, "name": f"{self.valves.MODEL_PREFIX}/{m}"} for m in models]
+        self._models_cache = (time.monotonic() + MODELS_CACHE_TTL, result)
+        return result
+
+    async def _list_openai_models(self, client: httpx.AsyncClient) -> list[str]:
+        if not self.openai_kwargs:
+            return []
+        try:
+            response = await client.get(
+                f"{self.openai_kwargs['base_url'].rstrip('/')}/models",
+                headers={"Authorization": f"Bearer {self.openai_kwargs['api_key']}"},
+            )
+            response.raise_for_status()
+            return [m["id"] for m in response.json()["data"] if m["id"] in self._enabled]
+        except Exception as e:
+            logger.warning("OpenAI error: %s", e)
+            return []
+
+    async def _list_ollama_models(self, client: httpx.AsyncClient) -> list[str]:
+        if not self.ollama_kwargs:
+            return []
+        try:
+            response = await client.get(f"{self.valves.OLLAMA_URL.rstrip('/')}/api/tags")
+            response.raise_for_status()
+            return [
+                (m.get("name") or m.get("model")) for m in response.json()["models"]
+            ]
+        except Exception as e:
+            logger.warning("Ollama error: %s", e)
+            return []
 
     def setup(self):
+        cfg_hash = hash(tuple(self.valves.model_dump().items()))
+        if self._cfg_hash == cfg_hash:
+            return
+        self._models_cache = None
+        self._model_cache.clear()
+        self._handler_cache.clear()
+        self._tools_cache.clear()
+        self._graph_cache.clear()
         v = self.valves
+        self._enabled = frozenset(s.strip() for s in v.ENABLED_MODELS.split(","))
         if v.OPENAI_API_KEY and v.OPENAI_BASE_URL:
             self.openai_kwargs = {
                 "base_url": v.OPENAI_BASE_URL,
@@ -157,6 +390,139 @@ class Pipe:
                 "public_key": v.LANGFUSE_PUBLIC_KEY,
                 "host": v.LANGFUSE_URL,
             }
+        self._cfg_hash = cfg_hash
+
+    def _get_model(self, model_id: str, source: str):
+        key = (model_id, source)
+        model = self._model_cache.get(key)
+        if model is None:
+            if source == "openai":
+                assert self.openai_kwargs, "OpenAI API"
+                model = ChatOpenAI(model=model_id, **self.openai_kwargs)  # type: ignore
+            else:
+                assert self.ollama_kwargs, "Ollama API"
+                model = ChatOllama(model=model_id, **self.ollama_kwargs)  # type: ignore
+            _bounded_insert(self._model_cache, key, model)
+        return model
+
+    def _get_callbacks(self, __user__: dict | None) -> list:
+        if not self.langfuse_kwargs:
+            return []
+        user_id = __user__["id"] if __user__ else None
+        handler = self._handler_cache.get(user_id)
+        if handler is None:
+            user_kwargs = {"user_id": user_id} if user_id else {}
+            handler = _QueuedCallbackHandler(**(self.langfuse_kwargs | user_kwargs))  # type: ignore
+            _bounded_insert(self._handler_cache, user_id, handler)
+        return [handler]
+
+    def _get_tools(self, __tools__: dict[str, dict]):
+        # sorted so the serialized tool schemas are byte-stable across calls,
+        # keeping the provider's prompt-cache prefix consistent
+        items = sorted(__tools__.items())
+        # keyed by content (name, description, schema): object ids change every
+        # request because the host rebinds the callables, and ids get recycled
+        dump = json.dumps(
+            [
+                [k, v["spec"]["description"], v["pydantic_model"].model_json_schema()]
+                for k, v in items
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        sig = hashlib.sha256(dump.encode()).hexdigest()
+        tools = self._tools_cache.get(sig)
+        if tools is None:
+            # the coroutine is a shim resolving the live callable through
+            # _request_tools at call time, so the cached tool objects stay
+            # immutable and safe to share between concurrent requests
+            tools = [
+                StructuredTool(
+                    func=None,
+                    name=name,
+                    coroutine=_dispatch_tool(name),
+                    args_schema=value["pydantic_model"],
+                    description=value["spec"]["description"],
+                )
+                for name, value in items
+            ]
+            _bounded_insert(self._tools_cache, sig, tools)
+        return sig, tools
+
+    def _get_graph(self, model_id: str, model, __tools__: dict[str, dict]):
+        sig, tools = self._get_tools(__tools__)
+        key = (model_id, sig)
+        graph = self._graph_cache.get(key)
+        if graph is None:
+            graph = create_react_agent(model, tools=tools)
+            _bounded_insert(self._graph_cache, key, graph)
+        return graph
+
+    def _get_response_cache(self) -> Cache:
+        if self._response_cache is None:
+            self._response_cache = Cache(RESPONSE_CACHE_DIR)
+        return self._response_cache
+
+    async def _cached_or_inflight(self, cache_key: str | None):
+        """Look up the response cache and the singleflight map. Returns
+        (cached, fut): a finished response to replay, or the future this call
+        must resolve as the leader (both None when caching is off)."""
+        if not cache_key:
+            return None, None
+        while True:
+            if cached := self._get_response_cache().get(cache_key):
+                return cached, None
+            if fut := self._inflight.get(cache_key):
+                try:
+                    # identical request already in flight; reuse its result.
+                    # shielded so a cancelled follower doesn't cancel the
+                    # shared future out from under the leader
+                    return await asyncio.shield(fut), None
+                except asyncio.CancelledError:
+                    task = asyncio.current_task()
+                    if fut.cancelled() and not (task and task.cancelling()):
+                        # the leader was torn down (client disconnect), not us;
+                        # loop around and take over as the new leader
+                        continue
+                    raise
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[cache_key] = fut
+            return None, fut
+
+    def _resolve_inflight(self, cache_key, fut, text: str) -> None:
+        if fut is None:
+            return
+        self._get_response_cache().set(
+            cache_key, text, expire=self.valves.RESPONSE_CACHE_TTL
+        )
+        fut.set_result(text)
+
+    def _fail_inflight(self, fut, error: Exception) -> None:
+        # followers should see the upstream error, not a bare cancellation
+        if fut is not None and not fut.done():
+            fut.set_exception(error)
+            fut.exception()  # pre-retrieve so a followerless leader doesn't warn
+
+    def _release_inflight(self, cache_key, fut) -> None:
+        if fut is None:
+            return
+        self._inflight.pop(cache_key, None)
+        if not fut.done():  # leader torn down mid-call, e.g. client disconnect
+            fut.cancel()
+
+    def _response_cache_key(
+        self, model_id: str, body: dict, __task__: str | None
+    ) -> str | None:
+        if self.valves.RESPONSE_CACHE_TTL <= 0:
+            return None
+        # an absent temperature means the provider default (sampled), so chat
+        # responses are only cached when the request pins temperature to 0;
+        # titles are throwaway metadata and worth caching regardless
+        if __task__ != "title_generation" and body.get("temperature") != 0:
+            return None
+        payload = {"m": model_id, "msgs": body["messages"], "task": __task__}
+        dump = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(dump.encode()).hexdigest()
 
     async def pipe(
         self,
@@ -170,80 +536,103 @@ class Pipe:
         if __task__ == "function_calling":
             return
 
-        self.setup()
         model_id = ".".join(body["model"].split(".")[1:])
-        if self.model_sources[model_id] == "openai":
-            assert self.openai_kwargs, "OpenAI API"
-            model = ChatOpenAI(model=model_id, **self.openai_kwargs)  # type: ignore
-        else:
-            assert self.ollama_kwargs, "Ollama API"
-            model = ChatOllama(model=model_id, **self.ollama_kwargs)  # type: ignore
-        if self.langfuse_kwargs:
-            user_kwargs = {"user_id": __user__["id"]} if __user__ else {}
-            callback_kwargs = self.langfuse_kwargs | user_kwargs
-            callbacks = [CallbackHandler(**callback_kwargs)]  # type: ignore
+        source = self.model_sources[model_id]
+        model = self._get_model(model_id, source)
+        if source == "openai":
+            chat_model = model.bind(
+                extra_body={"prompt_cache_key": prompt_cache_key(body["messages"])}
+            )
         else:
-            callbacks = []
+            chat_model = model
+        callbacks = self._get_callbacks(__user__)
         config = {"callbacks": callbacks}  # type: ignore
+        # built once; run_id is omitted when unknown so langgraph doesn't hash None
+        stream_config = (
+            config if message_id is None else config | {"run_id": message_id}
+        )
 
-        if __task__ == "title_generation":
-            content = model.invoke(body["messages"], config=config).content  # type: ignore
-            assert isinstance(content, str)
-            yield content
-            return
+        cache_key = self._response_cache_key(model_id, body, __task__)
+        batcher = _StatusBatcher(__event_emitter__)
 
-        if not __tools__:
-            async for chunk in model.astream(
-                body["messages"],
-                config=config | {"run_id": message_id},  # type: ignore
-            ):
-                content = chunk.content
-                assert isinstance(content, str)
-                yield content
-            return
+        try:
+            if __task__ == "title_generation":
+                cached, fut = await self._cached_or_inflight(cache_key)
+                if cached is not None:
+                    yield cached
+                    return
+                try:
+                    content = chat_model.invoke(body["messages"], config=config).content  # type: ignore
+                    assert isinstance(content, str)
+                    self._resolve_inflight(cache_key, fut, content)
+                    yield content
+                    return
+                except Exception as e:
+                    self._fail_inflight(fut, e)
+                    raise
+                finally:
+                    self._release_inflight(cache_key, fut)
 
-        send_citation = get_send_citation(__event_emitter__)
-        send_status = get_send_status(__event_emitter__)
+            if not __tools__:
+                cached, fut = await self._cached_or_inflight(cache_key)
+                if cached is not None:
+                    yield cached
+                    return
+                try:
+                    chunks = []
+                    async for chunk in chat_model.astream(
+                        body["messages"],
+                        config=stream_config,  # type: ignore
+                    ):
+                        content = chunk.content
+                        if type(content) is str:
+                            chunks.append(content)
+                            yield content
+                    self._resolve_inflight(cache_key, fut, "".join(chunks))
+                    return
+                except Exception as e:
+                    self._fail_inflight(fut, e)
+                    raise
+                finally:
+                    self._release_inflight(cache_key, fut)
 
-        tools = []
-        for key, value in __tools__.items():
-            tools.append(
-                StructuredTool(
-                    func=None,
-                    name=key,
-                    coroutine=value["callable"],
-                    args_schema=value["pydantic_model"],
-                    description=value["spec"]["description"],
-                )
-            )
-        graph = create_react_agent(model, tools=tools)
-        inputs = {"messages": body["messages"]}
-        num_tool_calls = 0
-        started_tools = set()
-        async for event in graph.astream_events(
-            inputs,
-            version="v2",
-            config=config | {"run_id": message_id},  # type: ignore
-        ):
-            kind = event["event"]
-            data = event["data"]
-            if kind == "on_chat_model_stream":
-                if "chunk" in data and (content := data["chunk"].content):
-                    yield content
-            elif kind == "on_tool_start":
-                yield "\n"
-                name = event["name"]
-                await send_status(f"Running tool {name}", False)
-                started_tools.add(name)
-            elif kind == "on_tool_end":
-                num_tool_calls += 1
-                name = event["name"]
-                await send_status(f"Tool '{name}' returned {data.get('output')}", True)
-                await send_citation(
-                    url=f"Tool call {num_tool_calls}",
-                    title=name,
-                    content=f"Tool '{name}' with inputs {data.get('input')} returned {data.get('output')}",
-                )
-                started_tools.remove(name)
-        for name in started_tools:
-            await send_status(f"Tool '{name}' failed.", True)
+            send_citation = get_send_citation(batcher)
+            send_status = get_send_status(batcher)
+
+            _request_tools.set({k: v["callable"] for k, v in __tools__.items()})
+            graph = self._get_graph(model_id, model, __tools__)
+            inputs = {"messages": body["messages"]}
+            num_tool_calls = 0
+            started_tools = set()
+            async for event in graph.astream_events(
+                inputs,
+                version="v2",
+                config=stream_config,  # type: ignore
+            ):
+                data = event["data"]
+                match event["event"]:
+                    case "on_chat_model_stream":
+                        if "chunk" in data and (content := data["chunk"].content):
+                            yield content
+                    case "on_tool_start":
+                        yield "\n"
+                        name = event["name"]
+                        await send_status(f"Running tool {name}", False)
+                        started_tools.add(name)
+                    case "on_tool_end":
+                        num_tool_calls += 1
+                        name = event["name"]
+                        await send_status(
+                            f"Tool '{name}' returned {data.get('output')}", True
+                        )
+                        await send_citation(
+                            url=f"Tool call {num_tool_calls}",
+                            title=name,
+                            content=f"Tool '{name}' with inputs {data.get('input')} returned {data.get('output')}",
+                        )
+                        started_tools.remove(name)
+            for name in started_tools:
+                await send_status(f"Tool '{name}' failed.", True)
+        finally:
+            await batcher.aclose()
+            await flush_callbacks(callbacks)